@@ -1,7 +1,6 @@
 import streamlit as st
 import polars as pl
 from pathlib import Path
-import pickle
 from datetime import date, timedelta
 from dotenv import load_dotenv
 import os
@@ -13,23 +12,28 @@ from high_density_lane_price_estimator import identify_optimal_price
 from plotting import display_results
 
 
-@st.cache_data
+@st.cache_resource
 def load_postcode_cache(postcode_cache_file_location):
+    # Memory-mapped rather than copied, so cache_resource hands out the same frame
     postcode_cache_file = Path(postcode_cache_file_location)
     if postcode_cache_file.exists():
-        with open(postcode_cache_file_location, "rb") as handle:
-            postcode_cache = pickle.load(handle)
+        postcode_cache = pl.read_ipc(postcode_cache_file, memory_map=True)
     else:
-        postcode_cache = {}
+        postcode_cache = None
     return postcode_cache
 
 
-postcode_cache = load_postcode_cache("postcode_cache.pickle")
+postcode_cache = load_postcode_cache("postcode_cache.arrow")
+if postcode_cache is None and Path("postcode_cache.pickle").exists():
+    st.warning(
+        "postcode_cache.pickle is no longer read; run convert_postcode_cache.py to create "
+        "postcode_cache.arrow, otherwise missing postcodes are not filled from the cache."
+    )
 
 
 
-@st.cache_data
-def load_filtered_data(use_live_data=False):
+@st.cache_resource
+def get_data_loader():
     # Load environment variables from .env
     load_dotenv()
     
@@ -44,31 +48,55 @@ def load_filtered_data(use_live_data=False):
         raise ValueError("Missing one or more SQL environment variables.")
     
     # Instantiate the DataLoader with credentials
-    loader = DataLoader(
+    return DataLoader(
         sql_server=sql_server,
         sql_database=sql_database,
         sql_username=sql_username,
         sql_password=sql_password,
-        postcode_cache=postcode_cache
+        postcode_cache=postcode_cache,
+        source="sql",
     )
-    
-    # Load data from SQL
-    df = loader.load(source="sql")
 
-    # data_loader = DataLoader(postcode_cache=postcode_cache)
-    # df = data_loader.load(source="parquet", path="./analysis/fls_data.parquet")
+
+@st.cache_resource
+def load_filtered_data(use_live_data=False):
+    # cache_resource hands every caller the same frame instead of unpickling a copy, so it must
+    # be treated as read-only; the cached helpers below derive new frames from it
+    loader = get_data_loader()
+
+    # Load the matching/pricing columns from SQL; only the last 365 days are used for pricing,
+    # so filter server-side. Display columns are fetched per result via loader.load_detail.
+    df = loader.load_core(since_date=date.today() - timedelta(days=365))
+
+    # data_loader = DataLoader(postcode_cache=postcode_cache, source="parquet", path="./analysis/fls_data.parquet")
+    # df = data_loader.load_core()
     return df
 
 
-# -- Load data --
-df = load_filtered_data()
+@st.cache_data
+def get_vehicle_types(use_live_data=False):
+    df = load_filtered_data(use_live_data)
+    return df.select("vehicle_type").unique().sort("vehicle_type").to_series().to_list()
+
+
+@st.cache_data
+def get_similar_routes(origin_postcode, dest_postcode, vehicle_type=None, use_live_data=False):
+    # Keyed on the scalar inputs only, so resubmitting the same search is served from the cache
+    df = load_filtered_data(use_live_data)
+    return find_similar_routes_by_postcode(
+        df,
+        origin_postcode=origin_postcode.replace(" ", "").upper(),
+        dest_postcode=dest_postcode.replace(" ", "").upper(),
+        vehicle_type=vehicle_type,
+    )
+
 
 # -- Page UI --
 st.title("Find Similar Routes")
 st.markdown("Search for similar routes within a defined radius or postcode match.")
 
 # -- Get unique vehicle types --
-vehicle_types = ["All vehicle types"] + df.select("vehicle_type").unique().sort("vehicle_type").to_series().to_list()
+vehicle_types = ["All vehicle types"] + get_vehicle_types()
 
 # -- Input form --
 with st.form("postcode_form"):
@@ -86,14 +114,14 @@ if submitted:
             with st.spinner("Finding similar routes..."):
                 try:
                     if selected_vehicle_type == "All vehicle types":
-                        df_filtered = df
+                        vehicle_type = None
                     else:
-                        df_filtered = df.filter(pl.col("vehicle_type") == selected_vehicle_type)
+                        vehicle_type = selected_vehicle_type
 
-                    matches_3_letter, within_10km, within_20km, matches_2_letter = find_similar_routes_by_postcode(
-                        df_filtered,
-                        origin_postcode=origin_postcode,
-                        dest_postcode=dest_postcode,
+                    matches_3_letter, within_10km, within_20km, matches_2_letter = get_similar_routes(
+                        origin_postcode,
+                        dest_postcode,
+                        vehicle_type=vehicle_type,
                     )
 
                 except Exception as e:
@@ -109,23 +137,27 @@ if submitted:
             pricing_stats = None
 
             if matches_3_letter_recent.height >= 25:
-                df_matches_pd = matches_3_letter_recent.to_pandas()
-                optimal_price = identify_optimal_price(df_matches_pd)
+                optimal_price = identify_optimal_price(matches_3_letter_recent)
                 if optimal_price is not None:
                     pricing_stats = {
                         "volume_time_weighted_avg_cost": optimal_price,
                         "explanation": "Estimated using lowest fair price in last 365 days"
                     }
 
-                display_results("3-letter postcode matches (last 365 days)", matches_3_letter_recent, price_estimate=optimal_price)
+                display_results(
+                    "3-letter postcode matches (last 365 days)",
+                    matches_3_letter_recent,
+                    get_data_loader(),
+                    price_estimate=optimal_price,
+                )
 
             elif matches_3_letter_recent.height > 0:
                 st.error("Not enough recent 3-letter matches (minimum 25 in last 365 days) for reliable price estimate.")
-                # display_results("3-letter postcode matches (last 365 days)", matches_3_letter)
+                # display_results("3-letter postcode matches (last 365 days)", matches_3_letter, get_data_loader())
 
-                # display_results("Routes within 10 km", within_10km)
-                # display_results("Routes within 20 km", within_20km)
-                # display_results("2-letter postcode matches", matches_2_letter)
+                # display_results("Routes within 10 km", within_10km, get_data_loader())
+                # display_results("Routes within 20 km", within_20km, get_data_loader())
+                # display_results("2-letter postcode matches", matches_2_letter, get_data_loader())
 
             else:
                 st.warning("No data available")
@@ -0,0 +1,23 @@
+import pickle
+import sys
+from pathlib import Path
+
+from data_loader import postcode_cache_to_frame
+
+
+def convert_postcode_cache(
+    pickle_location: str = "postcode_cache.pickle",
+    arrow_location: str = "postcode_cache.arrow",
+) -> None:
+    """
+    One-off migration of the pickled {(lat, lon): postcode} cache to an Arrow IPC file
+    that the app can memory-map at startup.
+    """
+    with open(pickle_location, "rb") as handle:
+        postcode_cache = pickle.load(handle)
+
+    postcode_cache_to_frame(postcode_cache).write_ipc(Path(arrow_location))
+
+
+if __name__ == "__main__":
+    convert_postcode_cache(*sys.argv[1:3])
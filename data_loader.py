@@ -1,8 +1,105 @@
 import polars as pl
 import pandas as pd
 import pyodbc
+import streamlit as st
 import requests
-from typing import Optional, Literal, Tuple
+from datetime import date
+from typing import Optional, Literal, Tuple, Union
+
+from price_estimator import create_route_key
+
+
+LOAD_SCHEMA = {
+    "origin_postcode": pl.Utf8,
+    "origin_lat": pl.Float64,
+    "origin_lon": pl.Float64,
+    "destination_postcode": pl.Utf8,
+    "dest_lat": pl.Float64,
+    "dest_lon": pl.Float64,
+    "vehicle_type": pl.Utf8,
+    "pickup_date": pl.Datetime,
+    "contract_type": pl.Utf8,
+    "journey_distance": pl.Float64,
+    "load_id": pl.Int64,
+    "shipper_price": pl.Float64,
+    "shipper_id": pl.Int64,
+    "carrier_price": pl.Float64,
+    "carrier_name": pl.Utf8,
+}
+
+SQL_COLUMNS = {
+    # Mapped from loads.from
+    "origin_postcode": "lf.postcode",
+    "origin_lat": "lf.latitude",
+    "origin_lon": "lf.longitude",
+    # Mapped from loads.to
+    "destination_postcode": "lt.postcode",
+    "dest_lat": "lt.latitude",
+    "dest_lon": "lt.longitude",
+    # Mapped from loads.load
+    "vehicle_type": "ll.vehicleDisplayName",
+    "pickup_date": "ll.collectBy",
+    "contract_type": "ll.jobDisplayDescription",
+    "journey_distance": "ll.distance",
+    "load_id": "ll.loadId",
+    "shipper_price": "ll.customerAgreedRate",
+    "shipper_id": "ll.customerContactId",
+    # Mapped from loads.order
+    "carrier_price": "lo.agreedRate",
+    "carrier_name": "lo.subcontractorName",
+}
+
+# Columns needed for route matching and pricing; everything else is only needed for display.
+# carrier_price and carrier_name come from loads.order, which can have several rows per load, so
+# both stay here; DETAIL_COLUMNS are all per load and can be joined back on load_id alone
+CORE_COLUMNS = [
+    "origin_postcode", "origin_lat", "origin_lon",
+    "destination_postcode", "dest_lat", "dest_lon",
+    "vehicle_type", "pickup_date", "load_id", "carrier_price", "carrier_name",
+]
+DETAIL_COLUMNS = [col for col in LOAD_SCHEMA if col not in CORE_COLUMNS]
+
+
+POSTCODE_CACHE_SCHEMA = {
+    "lat": pl.Float64,
+    "lon": pl.Float64,
+    "postcode": pl.Categorical,
+}
+
+
+def postcode_cache_to_frame(postcode_cache: dict[Tuple[float, float], str]) -> pl.DataFrame:
+    """
+    Convert a {(lat, lon): postcode} cache into the columnar form stored on disk.
+    """
+    return pl.DataFrame(
+        {
+            "lat": [lat for lat, _ in postcode_cache.keys()],
+            "lon": [lon for _, lon in postcode_cache.keys()],
+            "postcode": list(postcode_cache.values()),
+        },
+        schema=POSTCODE_CACHE_SCHEMA,
+    )
+
+
+def _sql_conn_is_alive(conn: pyodbc.Connection) -> bool:
+    # conn.closed only reflects a local close(), so probe the server to catch dropped connections
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1").fetchone()
+        return True
+    except pyodbc.Error:
+        return False
+
+
+@st.cache_resource(validate=_sql_conn_is_alive)
+def get_sql_conn(conn_str: str) -> pyodbc.Connection:
+    """
+    Open the SQL Server connection once per process and share it across reruns and sessions.
+    Autocommit stops the read-only queries leaving a transaction open on the long-lived connection.
+    """
+    return pyodbc.connect(conn_str, autocommit=True)
 
 
 class DataLoader:
@@ -12,7 +109,9 @@ class DataLoader:
         sql_database: Optional[str] = None,
         sql_username: Optional[str] = None,
         sql_password: Optional[str] = None,
-        postcode_cache: Optional[dict[Tuple[float, float], str]] = None,
+        postcode_cache: Optional[pl.DataFrame] = None,
+        source: Literal["parquet", "sql"] = "sql",
+        path: Optional[str] = None,
     ):
         self.connection_params = {
             "server": sql_server,
@@ -20,46 +119,148 @@ class DataLoader:
             "username": sql_username,
             "password": sql_password,
         }
-        self.postcode_cache = postcode_cache or {}
-
-    def load(self, source: Literal["parquet", "sql"], path: Optional[str] = None) -> pl.DataFrame:
-        schema = {
-            "origin_postcode": pl.Utf8,
-            "origin_lat": pl.Float64,
-            "origin_lon": pl.Float64,
-            "destination_postcode": pl.Utf8,
-            "dest_lat": pl.Float64,
-            "dest_lon": pl.Float64,
-            "vehicle_type": pl.Utf8,
-            "pickup_date": pl.Datetime,
-            "contract_type": pl.Utf8,
-            "journey_distance": pl.Float64,
-            "load_id": pl.Int64,
-            "shipper_price": pl.Float64,
-            "shipper_id": pl.Int64,
-            "carrier_price": pl.Float64,
-            "carrier_name": pl.Utf8,
-        }
+        # Where load_core and load_detail read from
+        self.source = source
+        self.path = path
+        # Cache frame has one row per (lat, lon) rounded to 2dp, see convert_postcode_cache.py.
+        # Only renamed, so the memory-mapped columns and the Categorical postcodes are not copied
+        if postcode_cache is None:
+            postcode_cache = pl.DataFrame(schema=POSTCODE_CACHE_SCHEMA)
+        self.postcode_cache_df = postcode_cache.rename(
+            {"lat": "lat_r", "lon": "lon_r", "postcode": "pc_from_cache"}
+        )
 
+    def load(
+        self,
+        source: Literal["parquet", "sql"],
+        path: Optional[str] = None,
+        since_date: Optional[date] = None,
+        vehicle_type: Optional[str] = None,
+        origin_prefix: Optional[str] = None,
+        dest_prefix: Optional[str] = None,
+        columns: Optional[list[str]] = None,
+    ) -> pl.DataFrame:
+        """
+        Load historical loads, optionally restricted at source to loads picked up on or after
+        since_date, a single vehicle_type, and/or routes between two 3-letter postcode prefixes
+        (in either direction; origin_prefix and dest_prefix must be given together).
+
+        columns limits which columns are read; all of LOAD_SCHEMA is read by default.
+        """
+        if (origin_prefix is None) != (dest_prefix is None):
+            raise ValueError("origin_prefix and dest_prefix must be provided together.")
+
+        df = self._read(
+            source,
+            path,
+            columns or list(LOAD_SCHEMA),
+            since_date=since_date,
+            vehicle_type=vehicle_type,
+            origin_prefix=origin_prefix,
+            dest_prefix=dest_prefix,
+        )
+        df = self._fill_missing_postcodes(df)
+        df = self._add_postcode_prefixes(df)
+
+        # Non-directional route_key is added once here rather than per search
+        return create_route_key(df)
+
+    def load_core(
+        self,
+        since_date: Optional[date] = None,
+        vehicle_type: Optional[str] = None,
+        origin_prefix: Optional[str] = None,
+        dest_prefix: Optional[str] = None,
+    ) -> pl.DataFrame:
+        """
+        Load only the columns used for route matching and pricing (CORE_COLUMNS) from this
+        loader's source. The remaining columns can be fetched later for a subset of rows with load_detail.
+        """
+        return self.load(
+            self.source,
+            self.path,
+            since_date=since_date,
+            vehicle_type=vehicle_type,
+            origin_prefix=origin_prefix,
+            dest_prefix=dest_prefix,
+            columns=CORE_COLUMNS,
+        )
+
+    def load_detail(self, load_ids: Union[pl.Series, list[int]]) -> pl.DataFrame:
+        """
+        Load the DETAIL_COLUMNS for the given load_ids from this loader's source, one row per load_id.
+        """
+        load_ids = pl.Series("load_id", load_ids, dtype=pl.Int64).unique().drop_nulls().to_list()
+        columns = ["load_id"] + DETAIL_COLUMNS
+        if not load_ids:
+            return pl.DataFrame(schema={col: LOAD_SCHEMA[col] for col in columns})
+
+        # SQL Server allows at most 2100 parameters per statement
+        chunks = [load_ids[i:i + 2000] for i in range(0, len(load_ids), 2000)]
+        # The source has a row per order, so keep one per load to avoid fanning out the join
+        return pl.concat(
+            [self._read(self.source, self.path, columns, load_ids=chunk) for chunk in chunks],
+            how="vertical",
+        ).unique(subset="load_id", keep="first", maintain_order=True)
+
+    def _read(
+        self,
+        source: Literal["parquet", "sql"],
+        path: Optional[str],
+        columns: list[str],
+        since_date: Optional[date] = None,
+        vehicle_type: Optional[str] = None,
+        origin_prefix: Optional[str] = None,
+        dest_prefix: Optional[str] = None,
+        load_ids: Optional[list[int]] = None,
+    ) -> pl.DataFrame:
         if source == "parquet":
             if path is None:
                 raise ValueError("You must provide a file path for parquet loading.")
-            df = pl.read_parquet(path)
+            ldf = pl.scan_parquet(path)
+            if since_date is not None:
+                ldf = ldf.filter(pl.col("pickup_date") >= since_date)
+            if vehicle_type is not None:
+                ldf = ldf.filter(pl.col("vehicle_type") == vehicle_type)
+            if origin_prefix is not None:
+                origin_3 = pl.col("origin_postcode").str.replace_all(" ", "").str.to_uppercase().str.slice(0, 3)
+                dest_3 = pl.col("destination_postcode").str.replace_all(" ", "").str.to_uppercase().str.slice(0, 3)
+                ldf = ldf.filter(
+                    ((origin_3 == origin_prefix) & (dest_3 == dest_prefix)) |
+                    ((origin_3 == dest_prefix) & (dest_3 == origin_prefix))
+                )
+            if load_ids is not None:
+                ldf = ldf.filter(pl.col("load_id").is_in(load_ids))
+            df = ldf.select(columns).collect()
             df = df.with_columns(
-                pl.col("origin_lat").cast(pl.Float64),
-                pl.col("origin_lon").cast(pl.Float64),
-                pl.col("dest_lat").cast(pl.Float64),
-                pl.col("dest_lon").cast(pl.Float64),
+                pl.col(col).cast(pl.Float64)
+                for col in ("origin_lat", "origin_lon", "dest_lat", "dest_lon")
+                if col in columns
             )
 
         elif source == "sql":
-            df = self._load_from_sql(schema)
+            df = self._load_from_sql(
+                {col: LOAD_SCHEMA[col] for col in columns},
+                since_date=since_date,
+                vehicle_type=vehicle_type,
+                origin_prefix=origin_prefix,
+                dest_prefix=dest_prefix,
+                load_ids=load_ids,
+            )
         else:
             raise ValueError("Source must be either 'parquet' or 'sql'.")
 
-        return self._fill_missing_postcodes(df)
+        return df
 
-    def _load_from_sql(self, schema) -> pl.DataFrame:
+    def _load_from_sql(
+        self,
+        schema,
+        since_date: Optional[date] = None,
+        vehicle_type: Optional[str] = None,
+        origin_prefix: Optional[str] = None,
+        dest_prefix: Optional[str] = None,
+        load_ids: Optional[list[int]] = None,
+    ) -> pl.DataFrame:
         conn_str = (
             f"DRIVER={{ODBC Driver 18 for SQL Server}};"
             f"SERVER={self.connection_params['server']};"
@@ -67,41 +268,46 @@ class DataLoader:
             f"UID={self.connection_params['username']};"
             f"PWD={self.connection_params['password']}"
         )
-        query = """
+        # Only select the columns asked for, see SQL_COLUMNS for the mapping from loads.*
+        select_list = ",\n          ".join(f"{SQL_COLUMNS[col]} AS {col}" for col in schema)
+        query = f"""
         SELECT
-          -- Mapped from loads.from
-          lf.postcode           AS origin_postcode,
-          lf.latitude           AS origin_lat,
-          lf.longitude          AS origin_lon,
-        
-          -- Mapped from loads.to
-          lt.postcode           AS destination_postcode,
-          lt.latitude           AS dest_lat,
-          lt.longitude          AS dest_lon,
-        
-          -- Mapped from loads.load
-          ll.vehicleDisplayName AS vehicle_type,
-          ll.collectBy          AS pickup_date,
-          ll.jobDisplayDescription AS contract_type,
-          ll.distance              AS journey_distance, 
-          ll.loadId                AS load_id,
-          ll.customerAgreedRate    as shipper_price,
-          ll.customerContactId     AS shipper_id,
-        
-          -- Mapped from loads.order
-          lo.agreedRate         AS carrier_price,
-          lo.subcontractorName  AS carrier_name
-        
+          {select_list}
         FROM loads.load ll
         JOIN loads."from" lf ON ll.loadId = lf.loadId
         JOIN loads."order" lo ON ll.loadId = lo.loadId
         JOIN loads."to" lt ON ll.loadId = lt.loadId
         WHERE lo.agreedRate IS NOT NULL
-          AND lo.agreedRate > 0;
+          AND lo.agreedRate > 0
         """
-        with pyodbc.connect(conn_str) as conn:
+        params = []
+        if since_date is not None:
+            query += " AND ll.collectBy >= ?"
+            params.append(since_date)
+        if vehicle_type is not None:
+            query += " AND ll.vehicleDisplayName = ?"
+            params.append(vehicle_type)
+        if origin_prefix is not None:
+            origin_3 = "UPPER(LEFT(REPLACE(lf.postcode, ' ', ''), 3))"
+            dest_3 = "UPPER(LEFT(REPLACE(lt.postcode, ' ', ''), 3))"
+            query += f" AND (({origin_3} = ? AND {dest_3} = ?) OR ({origin_3} = ? AND {dest_3} = ?))"
+            params.extend([origin_prefix, dest_prefix, dest_prefix, origin_prefix])
+        if load_ids is not None:
+            query += f" AND ll.loadId IN ({', '.join('?' for _ in load_ids)})"
+            params.extend(load_ids)
+
+        # The connection is shared, so give each read its own cursor rather than sharing one
+        cursor = get_sql_conn(conn_str).cursor()
+        try:
             # infer_schema_length, extends the read until it coerces the type
-            df = pl.read_database(query, conn, schema_overrides=schema)
+            df = pl.read_database(
+                query,
+                cursor,
+                schema_overrides=schema,
+                execute_options={"parameters": params} if params else None,
+            )
+        finally:
+            cursor.close()
         return df
 
     def fill_postcodes_from_cache_polars(
@@ -112,24 +318,31 @@ class DataLoader:
         postcode_col: str,
         rounding_dp: int = 2,
     ) -> pl.DataFrame:
-        updated_postcodes = []
-        for row in df.select([lat_col, lon_col, postcode_col]).iter_rows(named=True):
-            current_postcode = row[postcode_col]
-
-            if current_postcode is not None and len(current_postcode) > 3:
-                updated_postcodes.append(current_postcode)
-                continue
-
-            lat, lon = row[lat_col], row[lon_col]
-
-            if lat is None or lon is None:
-                updated_postcodes.append(None)
-                continue
+        # Keep postcodes that are already full, otherwise look up the rounded lat/lon in the cache
+        has_full_postcode = (pl.col(postcode_col).str.len_chars() > 3).fill_null(False)
 
-            key = (round(lat, rounding_dp), round(lon, rounding_dp))
-            updated_postcodes.append(self.postcode_cache.get(key, None))
+        # The cache is keyed on Python's round(), which rounds the exact binary value; Polars' .round()
+        # disagrees just either side of a half (e.g. 51.125), so only the rows needing a lookup use round()
+        def cache_key(col: str) -> pl.Expr:
+            return (
+                pl.when(has_full_postcode.not_()).then(pl.col(col))
+                .map_elements(lambda value: round(value, rounding_dp), return_dtype=pl.Float64)
+            )
 
-        return df.with_columns(pl.Series(postcode_col, updated_postcodes))
+        return (
+            df.with_columns(
+                cache_key(lat_col).alias("lat_r"),
+                cache_key(lon_col).alias("lon_r"),
+            )
+            .join(self.postcode_cache_df, on=["lat_r", "lon_r"], how="left", maintain_order="left")
+            .with_columns(
+                pl.when(has_full_postcode)
+                .then(pl.col(postcode_col))
+                .otherwise(pl.col("pc_from_cache").cast(pl.Utf8))
+                .alias(postcode_col)
+            )
+            .drop(["lat_r", "lon_r", "pc_from_cache"])
+        )
 
     def _fill_missing_postcodes(self, df: pl.DataFrame) -> pl.DataFrame:
         LATITUDE_DECIMAL_PLACE_ROUNDING = 2
@@ -151,3 +364,17 @@ class DataLoader:
         )
 
         return df
+
+    def _add_postcode_prefixes(self, df: pl.DataFrame) -> pl.DataFrame:
+        # Normalised postcodes and their prefixes, computed once here rather than on every search
+        df = df.with_columns([
+            pl.col("origin_postcode").str.replace_all(" ", "").str.to_uppercase().alias("origin_postcode_clean"),
+            pl.col("destination_postcode").str.replace_all(" ", "").str.to_uppercase().alias("destination_postcode_clean"),
+        ])
+
+        return df.with_columns([
+            pl.col("origin_postcode_clean").str.slice(0, 3).alias("origin_prefix_3"),
+            pl.col("destination_postcode_clean").str.slice(0, 3).alias("dest_prefix_3"),
+            pl.col("origin_postcode_clean").str.slice(0, 2).alias("origin_prefix_2"),
+            pl.col("destination_postcode_clean").str.slice(0, 2).alias("dest_prefix_2"),
+        ])
@@ -1,12 +1,38 @@
 import numpy as np
-import pandas as pd
-from scipy.stats import iqr, gaussian_kde
-from scipy.signal import find_peaks
+import polars as pl
+from scipy.signal import find_peaks, fftconvolve
 from typing import Optional, Union
 
 
+def _fft_kde(costs: np.ndarray, sigma: float, grid: np.ndarray) -> np.ndarray:
+    """
+    Gaussian KDE with kernel standard deviation sigma evaluated on an evenly spaced grid,
+    equivalent to gaussian_kde(costs, bw_method=sigma / np.std(costs, ddof=1))(grid) but
+    O(N + M log M) instead of O(N * M).
+
+    Samples are linearly binned onto the grid and the bin weights are convolved with the
+    Gaussian kernel via FFT. Assumes all samples lie within [grid[0], grid[-1]].
+    """
+    n_grid = len(grid)
+    dx = grid[1] - grid[0]
+
+    # Linear binning: split each sample's weight between its two neighbouring grid points
+    pos = (costs - grid[0]) / dx
+    lower = np.clip(np.floor(pos).astype(int), 0, n_grid - 2)
+    frac = pos - lower
+    weights = (
+        np.bincount(lower, weights=1 - frac, minlength=n_grid)
+        + np.bincount(lower + 1, weights=frac, minlength=n_grid)
+    )
+
+    offsets = np.arange(-(n_grid - 1), n_grid) * dx
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
+
+    return fftconvolve(weights, kernel, mode="valid") / len(costs)
+
+
 def identify_optimal_price(
-    df: pd.DataFrame,
+    df: pl.DataFrame,
     route_key: Optional[str] = None,
     vehicle_type: Optional[str] = None,
     target_bandwidth: float = 5
@@ -16,7 +42,7 @@ def identify_optimal_price(
     using KDE peak detection or fallback to most common price band.
 
     Parameters:
-        df (pd.DataFrame): Input DataFrame with 'carrier_price', 'route_key', and 'vehicle_type'.
+        df (pl.DataFrame): Input DataFrame with 'carrier_price', 'route_key', and 'vehicle_type'.
         route_key (str, optional): Route key to filter. If None, assumes df is pre-filtered.
         vehicle_type (str, optional): Vehicle type to filter. If None, assumes df is pre-filtered.
         target_bandwidth (float): Target bandwidth for KDE smoothing.
@@ -25,28 +51,34 @@ def identify_optimal_price(
         float or None: Optimal carrier price (baseline) or None if not enough data.
     """
     if route_key:
-        df = df[df["route_key"] == route_key]
+        df = df.filter(pl.col("route_key") == route_key)
     if vehicle_type:
-        df = df[df["vehicle_type"] == vehicle_type]
-
-    df = df.copy()
-    df["carrier_price"] = df["carrier_price"].astype(float)
-    costs = df["carrier_price"].dropna().values
+        df = df.filter(pl.col("vehicle_type") == vehicle_type)
 
-    if len(costs) < 5:
+    prices = df["carrier_price"].cast(pl.Float64).drop_nulls().drop_nans()
+    if len(prices) < 5:
         return None
 
-    cost_std = np.std(costs)
-    cost_iqr = iqr(costs)
+    # All the summary stats in a single pass over the column
+    cost_std, sample_std, cost_iqr, cost_min, cost_max = prices.to_frame().select([
+        pl.col("carrier_price").std(ddof=0),
+        pl.col("carrier_price").std(ddof=1).alias("sample_std"),
+        (
+            pl.col("carrier_price").quantile(0.75, interpolation="linear")
+            - pl.col("carrier_price").quantile(0.25, interpolation="linear")
+        ).alias("iqr"),
+        pl.col("carrier_price").min().alias("min"),
+        pl.col("carrier_price").max().alias("max"),
+    ]).row(0)
     spread = cost_iqr if cost_iqr > 0 else cost_std
     if spread == 0:
         return None
 
     bw_method = target_bandwidth / spread
-    kde = gaussian_kde(costs, bw_method=bw_method)
 
-    cost_range = np.linspace(costs.min(), costs.max(), 1000)
-    density = kde(cost_range)
+    costs = prices.to_numpy()
+    cost_range = np.linspace(cost_min, cost_max, 1000)
+    density = _fft_kde(costs, bw_method * sample_std, cost_range)
 
     peaks, _ = find_peaks(density)
     density_threshold = 0.1 * len(costs) / (cost_range.max() - cost_range.min())
@@ -56,10 +88,15 @@ def identify_optimal_price(
         if density[idx] >= density_threshold:
             return float(cost_range[idx])
 
-    # Fallback: most common price band
-    df["cost_group"] = (df["carrier_price"] // target_bandwidth) * target_bandwidth
-    group_counts = df["cost_group"].value_counts().sort_index()
-    if not group_counts.empty:
-        return float(group_counts.idxmax())
+    # Fallback: most common price band (lowest band wins ties)
+    top_group = (
+        prices.to_frame()
+        .group_by(((pl.col("carrier_price") // target_bandwidth) * target_bandwidth).alias("cost_group"))
+        .len()
+        .sort(["len", "cost_group"], descending=[True, False])
+        .head(1)
+    )
+    if not top_group.is_empty():
+        return float(top_group["cost_group"][0])
 
     return None
@@ -1,134 +1,151 @@
 import streamlit as st
 import polars as pl
 import plotly.express as px
+import plotly.graph_objects as go
 
-def display_results(label: str, result_df: pl.DataFrame, price_estimate: float | None = None):
+from data_loader import DataLoader
+
+# Above MAX_SCATTER_POINTS loads the scatter is downsampled per vehicle type, sharing
+# MAX_SCATTER_POINTS between the types but keeping at least MIN_SCATTER_POINTS_PER_VEHICLE_TYPE each
+MAX_SCATTER_POINTS = 2000
+MIN_SCATTER_POINTS_PER_VEHICLE_TYPE = 500
+
+HIST_BIN_WIDTH = 10
+
+# (column, label) options for colouring the scatter, the first is shown initially
+SCATTER_COLOR_GROUPS = [
+    ("vehicle_type", "Vehicle Type"),
+    ("shipper_id", "Shipper ID"),
+    ("carrier_name", "Carrier Name"),
+]
+
+def display_results(
+    label: str,
+    result_df: pl.DataFrame,
+    data_loader: DataLoader,
+    price_estimate: float | None = None,
+):
     st.subheader(f"{label} — {result_df.shape[0]} matches")
 
     if result_df.is_empty():
         st.info("No matches found.")
     else:
+        # Display-only columns (shipper, contract, ...) are only loaded for the loads being shown
+        result_df = result_df.join(data_loader.load_detail(result_df["load_id"]), on="load_id", how="left")
+
         #st.dataframe(result_df.to_pandas(), use_container_width=True)
 
-        plot_df = result_df.select([
+        result_df = result_df.select([
             "pickup_date", "carrier_price", "vehicle_type", "origin_postcode", "destination_postcode",
             "shipper_id", "carrier_name"
-        ]).sort("pickup_date").to_pandas()
+        ]).sort("pickup_date")
 
-        plot_df["route"] = (
-            plot_df["origin_postcode"].str.upper().str.strip() + " → " +
-            plot_df["destination_postcode"].str.upper().str.strip()
+        # Stratified sample per vehicle type so large result sets stay responsive in the browser
+        scatter_df = result_df
+        if scatter_df.height > MAX_SCATTER_POINTS:
+            n_groups = scatter_df["vehicle_type"].n_unique()
+            points_per_group = max(MIN_SCATTER_POINTS_PER_VEHICLE_TYPE, MAX_SCATTER_POINTS // n_groups)
+            scatter_df = scatter_df.filter(
+                pl.int_range(pl.len()).shuffle(seed=0).over("vehicle_type") < points_per_group
+            )
+
+        # Route label and string categories are built in Polars; the traces take the columns directly
+        scatter_df = scatter_df.with_columns(
+            pl.concat_str([
+                pl.col("origin_postcode").str.to_uppercase().str.strip_chars(),
+                pl.col("destination_postcode").str.to_uppercase().str.strip_chars(),
+            ], separator=" → ").alias("route"),
+            pl.col("shipper_id").cast(pl.Utf8),
+            pl.col("carrier_name").cast(pl.Utf8),
         )
 
-        # Convert for categorical treatment
-        plot_df["shipper_id"] = plot_df["shipper_id"].astype(str)
-        plot_df["carrier_name"] = plot_df["carrier_name"].astype(str)
+        # One WebGL scatter with a dropdown to choose what the points are coloured by
+        fig_scatter = go.Figure()
+        visibility = []
+        for group_col, group_label in SCATTER_COLOR_GROUPS:
+            categories_sorted = scatter_df.select(group_col).unique().sort(group_col).to_series().to_list()
+            groups = scatter_df.partition_by(group_col, as_dict=True)
+            for i, category in enumerate(categories_sorted):
+                group_df = groups[(category,)]
+                fig_scatter.add_trace(go.Scattergl(
+                    x=group_df["pickup_date"].to_numpy(),
+                    y=group_df["carrier_price"].to_numpy(),
+                    mode="markers",
+                    name=str(category),
+                    hovertext=group_df["route"].to_numpy(),
+                    hovertemplate=(
+                        f"<b>%{{hovertext}}</b><br>{group_label}={category}<br>"
+                        "Pickup Date=%{x}<br>Carrier Price (£)=%{y}<extra></extra>"
+                    ),
+                    marker=dict(color=px.colors.qualitative.Plotly[i % len(px.colors.qualitative.Plotly)]),
+                    opacity=0.8,
+                    visible=group_col == SCATTER_COLOR_GROUPS[0][0],
+                ))
+                visibility.append(group_col)
 
-        # Scatter plot by vehicle_type
-        fig_vehicle = px.scatter(
-            plot_df,
-            x="pickup_date",
-            y="carrier_price",
-            color="vehicle_type",
-            hover_name="route",
-            title="Carrier Price over Time by Vehicle Type",
-            labels={
-                "pickup_date": "Pickup Date",
-                "carrier_price": "Carrier Price (£)",
-                "vehicle_type": "Vehicle Type"
-            },
-            opacity=0.8,
-            template="plotly_white"
-        )
-        if price_estimate is not None:
-            fig_vehicle.add_hline(
-                y=price_estimate,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Estimated Price £{price_estimate:.2f}",
-                annotation_position="top left"
+        buttons = [
+            dict(
+                label=group_label,
+                method="update",
+                args=[
+                    {"visible": [trace_group == group_col for trace_group in visibility]},
+                    {
+                        "title.text": f"Carrier Price over Time by {group_label}",
+                        "legend.title.text": group_label,
+                    },
+                ],
             )
-        st.plotly_chart(fig_vehicle, use_container_width=True, key=f"plot_vehicle_{label}")
-
-        # Scatter plot by shipper_id
-        shipper_ids_sorted = sorted(plot_df["shipper_id"].unique())
-        fig_shipper = px.scatter(
-            plot_df,
-            x="pickup_date",
-            y="carrier_price",
-            color="shipper_id",
-            category_orders={"shipper_id": shipper_ids_sorted},
-            hover_name="route",
-            title="Carrier Price over Time by Shipper ID",
-            labels={
-                "pickup_date": "Pickup Date",
-                "carrier_price": "Carrier Price (£)",
-                "shipper_id": "Shipper ID"
-            },
-            opacity=0.8,
-            template="plotly_white"
-        )
-        fig_shipper.update_layout(
-            legend_title_text='Shipper ID',
+            for group_col, group_label in SCATTER_COLOR_GROUPS
+        ]
+        fig_scatter.update_layout(
+            title=f"Carrier Price over Time by {SCATTER_COLOR_GROUPS[0][1]}",
+            xaxis_title="Pickup Date",
+            yaxis_title="Carrier Price (£)",
+            template="plotly_white",
+            legend_title_text=SCATTER_COLOR_GROUPS[0][1],
             legend=dict(
                 itemsizing='constant',
                 itemclick='toggleothers',
                 itemdoubleclick='toggle'
-            )
+            ),
+            updatemenus=[dict(buttons=buttons, direction="down", x=1.0, xanchor="right", y=1.15, yanchor="top")],
         )
         if price_estimate is not None:
-            fig_shipper.add_hline(
+            fig_scatter.add_hline(
                 y=price_estimate,
                 line_dash="dash",
                 line_color="red",
                 annotation_text=f"Estimated Price £{price_estimate:.2f}",
                 annotation_position="top left"
             )
-        st.plotly_chart(fig_shipper, use_container_width=True, key=f"plot_shipper_{label}")
+        if scatter_df.height < result_df.height:
+            st.caption(f"Showing a sample of {scatter_df.height} of {result_df.height} loads.")
+        st.plotly_chart(fig_scatter, use_container_width=True, key=f"plot_scatter_{label}")
 
-        # Scatter plot by carrier_name
-        carrier_names_sorted = sorted(plot_df["carrier_name"].unique())
-        fig_carrier = px.scatter(
-            plot_df,
-            x="pickup_date",
-            y="carrier_price",
-            color="carrier_name",
-            category_orders={"carrier_name": carrier_names_sorted},
-            hover_name="route",
-            title="Carrier Price over Time by Carrier Name",
-            labels={
-                "pickup_date": "Pickup Date",
-                "carrier_price": "Carrier Price (£)",
-                "carrier_name": "Carrier Name"
-            },
-            opacity=0.8,
-            template="plotly_white"
-        )
-        fig_carrier.update_layout(
-            legend_title_text='Carrier Name',
-            legend=dict(
-                itemsizing='constant',
-                itemclick='toggleothers',
-                itemdoubleclick='toggle'
-            )
+        # --- Histogram with price overlay ---
+        # Bin in Polars and send only the bin counts to the browser, not every price. Bins are
+        # left-closed [edge, edge + £10) like px.histogram's, so a round £150 lands in the 150 bar
+        hist_df = (
+            result_df
+            .select(((pl.col("carrier_price") // HIST_BIN_WIDTH) * HIST_BIN_WIDTH).alias("bin_start"))
+            .drop_nulls()
+            .group_by("bin_start")
+            .len()
+            .sort("bin_start")
         )
-        if price_estimate is not None:
-            fig_carrier.add_hline(
-                y=price_estimate,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Estimated Price £{price_estimate:.2f}",
-                annotation_position="top left"
-            )
-        st.plotly_chart(fig_carrier, use_container_width=True, key=f"plot_carrier_{label}")
 
-        # --- Histogram with price overlay ---
-        hist_fig = px.histogram(
-            plot_df,
-            x="carrier_price",
-            nbins=max(1, int((plot_df["carrier_price"].max() - plot_df["carrier_price"].min()) / 10)),
+        hist_fig = go.Figure(go.Bar(
+            x=(hist_df["bin_start"] + HIST_BIN_WIDTH / 2).to_numpy(),
+            y=hist_df["len"].to_numpy(),
+            width=HIST_BIN_WIDTH,
+            customdata=hist_df.select("bin_start", (pl.col("bin_start") + HIST_BIN_WIDTH).alias("bin_end")).to_numpy(),
+            hovertemplate="Carrier Price (£)=[%{customdata[0]}, %{customdata[1]})<br>count=%{y}<extra></extra>",
+        ))
+        hist_fig.update_layout(
             title="Carrier Price Distribution (£10 bins)",
-            labels={"carrier_price": "Carrier Price (£)"},
+            xaxis_title="Carrier Price (£)",
+            yaxis_title="count",
+            bargap=0,
             template="plotly_white"
         )
         if price_estimate is not None:
@@ -38,8 +38,6 @@ def estimate_price_from_df(
     if df.is_empty():
         return None
 
-    df = create_route_key(df)
-
     filtered_df = df.filter(
         (pl.col("carrier_price").is_not_null()) &
         (pl.col("carrier_price") != 0) &
@@ -66,24 +64,15 @@ def estimate_price_from_df(
             pl.lit(1.0).alias("time_weight")
         ])
 
-    grouped = df_with_weight.group_by(["route_key", "carrier_price"]).agg([
-        pl.count().alias("volume"),
-        pl.mean("time_weight").alias("avg_time_weight")
-    ])
-
-    grouped = grouped.with_columns([
-        (pl.col("volume") * pl.col("avg_time_weight")).alias("adjusted_volume"),
-        (pl.col("carrier_price") * pl.col("volume") * pl.col("avg_time_weight")).alias("adjusted_cost")
-    ])
-
-    stats = grouped.select([
-        (pl.col("adjusted_cost").sum() / pl.col("adjusted_volume").sum()).alias("volume_time_weighted_avg_cost"),
+    # Single pass over the loads; sum(price * weight) / sum(weight) is the volume/time weighted mean
+    stats = df_with_weight.select([
+        ((pl.col("carrier_price") * pl.col("time_weight")).sum() / pl.col("time_weight").sum()).alias("volume_time_weighted_avg_cost"),
         pl.col("carrier_price").mean().alias("avg_cost"),
         pl.col("carrier_price").median().alias("median_cost"),
         pl.col("carrier_price").min().alias("min_cost"),
         pl.col("carrier_price").max().alias("max_cost"),
         pl.col("carrier_price").std(ddof=1).alias("stddev_cost"),
-        pl.col("volume").sum().alias("valid_count")
+        pl.len().alias("valid_count")
     ])
 
     return dict(zip(stats.columns, stats.row(0)))
@@ -1,21 +1,108 @@
 import polars as pl
+import atexit
+import logging
 import math
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Reuse TCP/TLS connections to postcodes.io across lookups
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+POSTCODE_LAT_LON_CACHE_FILE = Path("postcode_lat_lon_cache.arrow")
+
+
+def load_postcode_lat_lon_cache(path: Path = POSTCODE_LAT_LON_CACHE_FILE) -> dict[str, tuple[float, float]]:
+    if not path.exists():
+        return {}
+    cache_df = pl.read_ipc(path)
+    return {
+        postcode: (lat, lon)
+        for postcode, lat, lon in cache_df.select(["postcode", "lat", "lon"]).iter_rows()
+    }
+
+
+def save_postcode_lat_lon_cache(
+    items: list[tuple[str, tuple[float, float]]],
+    path: Path = POSTCODE_LAT_LON_CACHE_FILE,
+) -> None:
+    cache_df = pl.DataFrame(
+        {
+            "postcode": [postcode for postcode, _ in items],
+            "lat": [lat for _, (lat, _) in items],
+            "lon": [lon for _, (_, lon) in items],
+        },
+        schema={"postcode": pl.Utf8, "lat": pl.Float64, "lon": pl.Float64},
+    )
+    # Write to a unique temp file then rename, so a reader never sees a partial file
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+    try:
+        cache_df.write_ipc(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
-postcode_cache = {}
 
-import requests
+postcode_cache: dict[str, tuple[float, float]] = load_postcode_lat_lon_cache()
+
+# Streamlit sessions run in threads, so cache updates and saves go through this lock
+_postcode_cache_lock = threading.Lock()
+_postcode_cache_dirty = False
+_postcode_cache_last_save = 0.0
+POSTCODE_CACHE_SAVE_INTERVAL_S = 30.0
 
-postcode_cache: dict[str, tuple[float, float]] = {}
 
-def get_lat_lon_from_api(postcode: str) -> tuple[float, float]:
+def _cache_lat_lons(lat_lons: dict[str, tuple[float, float]]) -> None:
+    global _postcode_cache_dirty
+    if not lat_lons:
+        return
+    with _postcode_cache_lock:
+        postcode_cache.update(lat_lons)
+        _postcode_cache_dirty = True
+    flush_postcode_lat_lon_cache()
+
+
+def flush_postcode_lat_lon_cache(force: bool = False) -> None:
+    """
+    Persist new cache entries, at most once every POSTCODE_CACHE_SAVE_INTERVAL_S unless forced.
+    Write failures are logged rather than raised so they never fail a lookup.
+    """
+    global _postcode_cache_dirty, _postcode_cache_last_save
+    with _postcode_cache_lock:
+        now = time.monotonic()
+        if not _postcode_cache_dirty:
+            return
+        if not force and now - _postcode_cache_last_save < POSTCODE_CACHE_SAVE_INTERVAL_S:
+            return
+        try:
+            save_postcode_lat_lon_cache(list(postcode_cache.items()))
+        except Exception:
+            logger.warning("Could not save postcode lat/lon cache to %s", POSTCODE_LAT_LON_CACHE_FILE, exc_info=True)
+            return
+        _postcode_cache_dirty = False
+        _postcode_cache_last_save = now
+
+
+# Don't lose entries that arrived since the last debounced save
+atexit.register(flush_postcode_lat_lon_cache, force=True)
+
+
+def get_lat_lon_from_api(postcode: str, skip_full_lookup: bool = False) -> tuple[float, float]:
     """
     Retrieve the latitude and longitude for a given UK postcode using the postcodes.io API.
 
     Algorithm:
     1. Clean the postcode by removing spaces and converting to uppercase.
-    2. If the postcode is cached, return the cached result.
-    3. If the cleaned postcode length is greater than 4:
+    2. If the postcode is cached (in memory, persisted to POSTCODE_LAT_LON_CACHE_FILE), return the cached result.
+    3. If the cleaned postcode length is greater than 4 (and skip_full_lookup is False):
        - First attempt a full postcode lookup via the `/postcodes/` endpoint.
        - If that fails, fallback to the first 4 characters via the `/outcodes/` endpoint.
     4. If the postcode is 4 characters or fewer, or if the above attempts fail:
@@ -24,6 +111,8 @@ def get_lat_lon_from_api(postcode: str) -> tuple[float, float]:
 
     Parameters:
         postcode (str): The UK postcode to look up.
+        skip_full_lookup (bool): Go straight to the outcode fallbacks, e.g. when the full
+            postcode has already been tried via get_lat_lons_bulk.
 
     Returns:
         tuple[float, float]: A tuple of (latitude, longitude) if found.
@@ -37,7 +126,10 @@ def get_lat_lon_from_api(postcode: str) -> tuple[float, float]:
         return postcode_cache[postcode]
 
     def fetch_lat_lon(url: str) -> tuple[float, float] | None:
-        resp = requests.get(url)
+        try:
+            resp = _session.get(url, timeout=3)
+        except requests.RequestException:
+            return None
         if resp.status_code == 200:
             result = resp.json().get("result")
             if result:
@@ -48,8 +140,9 @@ def get_lat_lon_from_api(postcode: str) -> tuple[float, float]:
 
     if len(postcode) > 4:
         # Try full postcode first
-        url = f"https://api.postcodes.io/postcodes/{postcode}"
-        lat_lon = fetch_lat_lon(url)
+        if not skip_full_lookup:
+            url = f"https://api.postcodes.io/postcodes/{postcode}"
+            lat_lon = fetch_lat_lon(url)
 
         # Fallback to first 4 characters
         if lat_lon is None and len(postcode) >= 4:
@@ -64,34 +157,98 @@ def get_lat_lon_from_api(postcode: str) -> tuple[float, float]:
         lat_lon = fetch_lat_lon(url_3)
 
     if lat_lon is not None:
-        postcode_cache[postcode] = lat_lon
+        _cache_lat_lons({postcode: lat_lon})
         return lat_lon
     else:
         raise ValueError(f"Postcode '{postcode}' not found after all fallback attempts.")
 
 
-def haversine_expr(lat1, lon1, lat2, lon2):
-    R = 6371  # Earth radius in km
+def get_lat_lons_bulk(postcodes: list[str]) -> dict[str, tuple[float, float]]:
+    """
+    Retrieve the latitude and longitude for several UK postcodes with a single request to the
+    postcodes.io bulk endpoint (`POST /postcodes`, up to 100 postcodes per request).
 
-    lat1_rad = pl.col(lat1).radians()
-    lon1_rad = pl.col(lon1).radians()
+    Cached postcodes are not requested again. Any postcode the bulk lookup cannot resolve falls
+    back to the outcode lookups in get_lat_lon_from_api.
 
-    # If lat2 and lon2 are scalars (float), convert to literals in radians
-    lat2_rad = pl.lit(math.radians(lat2))
-    lon2_rad = pl.lit(math.radians(lon2))
+    Parameters:
+        postcodes (list[str]): The UK postcodes to look up.
 
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
+    Returns:
+        dict[str, tuple[float, float]]: (latitude, longitude) keyed by cleaned postcode
+        (spaces removed, uppercase).
+
+    Raises:
+        ValueError: If any postcode could not be retrieved after all fallback attempts.
+    """
+    cleaned = list(dict.fromkeys(postcode.replace(" ", "").upper() for postcode in postcodes))
+    lat_lons = {postcode: postcode_cache[postcode] for postcode in cleaned if postcode in postcode_cache}
+
+    # Only full postcodes are worth sending to the bulk endpoint
+    to_fetch = [postcode for postcode in cleaned if postcode not in lat_lons and len(postcode) > 4]
+    bulk_attempted = set()
+    for i in range(0, len(to_fetch), 100):
+        batch = to_fetch[i:i + 100]
+        try:
+            resp = _session.post("https://api.postcodes.io/postcodes", json={"postcodes": batch}, timeout=3)
+        except requests.RequestException:
+            continue
+        if resp.status_code != 200:
+            continue
+        bulk_attempted.update(batch)
+        for item in resp.json().get("result") or []:
+            result = item.get("result")
+            if result:
+                lat_lons[item["query"]] = (result["latitude"], result["longitude"])
+
+    _cache_lat_lons({postcode: lat_lons[postcode] for postcode in bulk_attempted if postcode in lat_lons})
+
+    for postcode in cleaned:
+        if postcode not in lat_lons:
+            lat_lons[postcode] = get_lat_lon_from_api(postcode, skip_full_lookup=postcode in bulk_attempted)
+
+    return lat_lons
+
+
+EARTH_RADIUS_KM = 6371
+
+
+class HaversineTarget:
+    """
+    A fixed (lat, lon) point whose trig terms are computed once, so distance expressions
+    to it are plain column arithmetic.
+    """
+
+    def __init__(self, lat: float, lon: float):
+        self.lat_rad = math.radians(lat)
+        self.lon_rad = math.radians(lon)
+        self.cos_lat = math.cos(self.lat_rad)
+
+    def expr(self, lat_col: str, lon_col: str) -> pl.Expr:
+        """Great-circle distance in km from (lat_col, lon_col) to this point."""
+        lat_rad = pl.col(lat_col).radians()
+
+        dlat = lat_rad - self.lat_rad
+        dlon = pl.col(lon_col).radians() - self.lon_rad
+
+        a = (dlat / 2).sin() ** 2 + lat_rad.cos() * self.cos_lat * (dlon / 2).sin() ** 2
+        return 2 * EARTH_RADIUS_KM * a.sqrt().arcsin()
+
+
+def route_pair_expr(origin_col: str, dest_col: str, origin: str, dest: str) -> pl.Expr:
+    """
+    True where (origin_col, dest_col) is (origin, dest) or (dest, origin), as a single
+    set-membership test on the pair rather than four string comparisons.
+    """
+    target_pairs = pl.Series([
+        {origin_col: origin, dest_col: dest},
+        {origin_col: dest, dest_col: origin},
+    ])
+    return pl.struct([origin_col, dest_col]).is_in(target_pairs.implode())
 
-    a = (
-        (dlat / 2).map_elements(math.sin, return_dtype=pl.Float64) ** 2
-        + lat1_rad.map_elements(math.cos, return_dtype=pl.Float64)
-        * pl.lit(math.cos(math.radians(lat2)))
-        * (dlon / 2).map_elements(math.sin, return_dtype=pl.Float64) ** 2
-    )
 
-    c = a.map_elements(lambda x: 2 * math.asin(math.sqrt(x)), return_dtype=pl.Float64)
-    return c * R
+# ~28km of latitude; anything further away cannot fall inside the 20km radius
+BOUNDING_BOX_LAT_DEGREES = 0.25
 
 from typing import Optional
 
@@ -109,28 +266,17 @@ def find_similar_routes_by_postcode(
     origin_prefix_2 = origin_postcode_clean[:2]
     dest_prefix_2 = dest_postcode_clean[:2]
 
-    target_origin_lat, target_origin_lon = get_lat_lon_from_api(origin_postcode_clean)
-    target_dest_lat, target_dest_lon = get_lat_lon_from_api(dest_postcode_clean)
+    lat_lons = get_lat_lons_bulk([origin_postcode_clean, dest_postcode_clean])
+    target_origin_lat, target_origin_lon = lat_lons[origin_postcode_clean]
+    target_dest_lat, target_dest_lon = lat_lons[dest_postcode_clean]
 
-    df = df.with_columns([
-        haversine_expr("origin_lat", "origin_lon", target_origin_lat, target_origin_lon).alias("forward_origin_dist"),
-        haversine_expr("dest_lat", "dest_lon", target_dest_lat, target_dest_lon).alias("forward_dest_dist"),
-        haversine_expr("origin_lat", "origin_lon", target_dest_lat, target_dest_lon).alias("reverse_origin_dist"),
-        haversine_expr("dest_lat", "dest_lon", target_origin_lat, target_origin_lon).alias("reverse_dest_dist"),
-        pl.col("origin_postcode").str.replace_all(" ", "").str.to_uppercase().alias("origin_postcode_clean"),
-        pl.col("destination_postcode").str.replace_all(" ", "").str.to_uppercase().alias("destination_postcode_clean"),
-    ])
-
-    df = df.with_columns([
-        pl.col("origin_postcode_clean").str.slice(0, 3).alias("origin_prefix_3"),
-        pl.col("destination_postcode_clean").str.slice(0, 3).alias("dest_prefix_3"),
-        pl.col("origin_postcode_clean").str.slice(0, 2).alias("origin_prefix_2"),
-        pl.col("destination_postcode_clean").str.slice(0, 2).alias("dest_prefix_2"),
-    ])
+    # Prefix columns are precomputed by DataLoader.load
+    ldf = df.lazy()
 
+    # Display-only columns are joined back on load_id by DataLoader.load_detail
     required_cols = [
         "origin_postcode", "destination_postcode", "carrier_price",
-        "vehicle_type", "pickup_date", "contract_type", "shipper_price", "carrier_name", "shipper_id"
+        "vehicle_type", "pickup_date", "load_id", "carrier_name", "route_key"
     ]
 
     carrier_price_filter = (pl.col("carrier_price").is_not_null()) & (pl.col("carrier_price") != 0)
@@ -143,32 +289,50 @@ def find_similar_routes_by_postcode(
 
     combined_filter = carrier_price_filter & vehicle_filter
 
-    matches_3_letter = df.filter(
-        combined_filter & (
-            ((pl.col("origin_prefix_3") == origin_prefix_3) & (pl.col("dest_prefix_3") == dest_prefix_3)) |
-            ((pl.col("origin_prefix_3") == dest_prefix_3) & (pl.col("dest_prefix_3") == origin_prefix_3))
-        )
+    matches_3_letter = ldf.filter(
+        combined_filter &
+        route_pair_expr("origin_prefix_3", "dest_prefix_3", origin_prefix_3, dest_prefix_3)
     ).select(required_cols)
 
-    matches_2_letter = df.filter(
-        combined_filter & (
-            ((pl.col("origin_prefix_2") == origin_prefix_2) & (pl.col("dest_prefix_2") == dest_prefix_2)) |
-            ((pl.col("origin_prefix_2") == dest_prefix_2) & (pl.col("dest_prefix_2") == origin_prefix_2))
-        )
+    matches_2_letter = ldf.filter(
+        combined_filter &
+        route_pair_expr("origin_prefix_2", "dest_prefix_2", origin_prefix_2, dest_prefix_2)
     ).select(required_cols)
 
-    within_10km = df.filter(
-        combined_filter & (
-            ((pl.col("forward_origin_dist") <= 10.0) & (pl.col("forward_dest_dist") <= 10.0)) |
-            ((pl.col("reverse_origin_dist") <= 10.0) & (pl.col("reverse_dest_dist") <= 10.0))
-        )
+    # Cheap latitude bounding box so the trig below only runs on rows that could be within 20km
+    forward_box = (
+        ((pl.col("origin_lat") - target_origin_lat).abs() <= BOUNDING_BOX_LAT_DEGREES) &
+        ((pl.col("dest_lat") - target_dest_lat).abs() <= BOUNDING_BOX_LAT_DEGREES)
+    )
+    reverse_box = (
+        ((pl.col("origin_lat") - target_dest_lat).abs() <= BOUNDING_BOX_LAT_DEGREES) &
+        ((pl.col("dest_lat") - target_origin_lat).abs() <= BOUNDING_BOX_LAT_DEGREES)
+    )
+
+    origin_target = HaversineTarget(target_origin_lat, target_origin_lon)
+    dest_target = HaversineTarget(target_dest_lat, target_dest_lon)
+
+    near_ldf = ldf.filter(combined_filter & (forward_box | reverse_box)).with_columns([
+        origin_target.expr("origin_lat", "origin_lon").alias("forward_origin_dist"),
+        dest_target.expr("dest_lat", "dest_lon").alias("forward_dest_dist"),
+        dest_target.expr("origin_lat", "origin_lon").alias("reverse_origin_dist"),
+        origin_target.expr("dest_lat", "dest_lon").alias("reverse_dest_dist"),
+    ])
+
+    within_10km = near_ldf.filter(
+        ((pl.col("forward_origin_dist") <= 10.0) & (pl.col("forward_dest_dist") <= 10.0)) |
+        ((pl.col("reverse_origin_dist") <= 10.0) & (pl.col("reverse_dest_dist") <= 10.0))
     ).select(required_cols)
 
-    within_20km = df.filter(
-        combined_filter & (
-            ((pl.col("forward_origin_dist") <= 20.0) & (pl.col("forward_dest_dist") <= 20.0)) |
-            ((pl.col("reverse_origin_dist") <= 20.0) & (pl.col("reverse_dest_dist") <= 20.0))
-        )
+    within_20km = near_ldf.filter(
+        ((pl.col("forward_origin_dist") <= 20.0) & (pl.col("forward_dest_dist") <= 20.0)) |
+        ((pl.col("reverse_origin_dist") <= 20.0) & (pl.col("reverse_dest_dist") <= 20.0))
     ).select(required_cols)
 
+    # Collect all four together so the bounding-box and haversine distance subplan shared by the
+    # 10km and 20km queries is only evaluated once
+    matches_3_letter, within_10km, within_20km, matches_2_letter = pl.collect_all(
+        [matches_3_letter, within_10km, within_20km, matches_2_letter]
+    )
+
     return matches_3_letter, within_10km, within_20km, matches_2_letter